@@ -1,20 +1,49 @@
-import requests
+import aiohttp
+import asyncio
+import aiodns
+from aiolimiter import AsyncLimiter
+from urllib.parse import urlsplit
 import pandas as pd
-import ipaddress
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
 from datetime import datetime
+from contextlib import ExitStack
 from ipwhois import IPWhois
+from pybloom_live import ScalableBloomFilter
 from ipwhois.exceptions import IPDefinedError, HTTPLookupError
 import time
 import socket
-import subprocess
+import struct
 import re
 import os
+import csv
+import io
+import mmap
+import json
+import orjson
+import sqlite3
 from typing import Dict, List, Tuple
 
 # File paths and configuration
 INPUT_FILE = 'unique-ips.log'
 OUTPUT_FILE_PREFIX = 'ripe_ris_data_full'
-RATE_LIMIT_DELAY = 300  # Delay in milliseconds between API calls
+CACHE_FILE = '.asn_cache.sqlite'
+CACHE_TTL = 7 * 24 * 3600  # Seconds before cached lookups are queried again
+UNRESOLVED_FILE = f'{OUTPUT_FILE_PREFIX}_unresolved.bloom'
+UNRESOLVED_ERROR_RATE = 0.01  # False positive rate of the unresolved subnet filter
+WHOIS_TIMEOUT = 30  # Seconds to wait on the Team Cymru WHOIS socket
+RATE_LIMIT_PER_HOST = 5  # Requests per second allowed against each API host
+MAX_CONCURRENT_SUBNETS = 16  # Subnets resolved in parallel
+CHECKPOINT_INTERVAL = 50  # Subnets between flushes of the output and checkpoint files
+MAX_CONCURRENT_DNS = 64  # Parallel Team Cymru DNS lookups for --check-missing
+MAX_RETRIES = 3  # Retries for connection errors and transient HTTP statuses
+RETRY_BACKOFF = 0.3  # Base backoff in seconds, doubled after each retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_IP_RE = re.compile(rb'\b(?:\d{1,3}\.){3}\d{1,3}\b')
 
 # Comprehensive list of RIR and regional routing data APIs
 ROUTING_APIS = {
@@ -41,88 +70,337 @@ ROUTING_APIS = {
     ]
 }
 
-def query_cymru_dns(ip):
+async def query_txt(resolver, name):
+    try:
+        records = await resolver.query(name, 'TXT')
+    except aiodns.error.DNSError:
+        return None
+    if not records:
+        return None
+    text = records[0].text
+    return text.decode(errors='replace') if isinstance(text, bytes) else text
+
+async def query_cymru_dns(resolver, ip):
     reversed_ip = '.'.join(reversed(ip.split('.')))
     
-    cmd = f"dig +short {reversed_ip}.origin.asn.cymru.com TXT"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if not result.stdout:
+    origin = await query_txt(resolver, f"{reversed_ip}.origin.asn.cymru.com")
+    if not origin:
         return None, None
     
-    asn = result.stdout.split('|')[0].strip().strip('"')
+    asn = origin.split('|')[0].strip()
     
-    cmd = f"dig +short AS{asn}.asn.cymru.com TXT"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if not result.stdout:
+    description = await query_txt(resolver, f"AS{asn}.asn.cymru.com")
+    if not description:
         return None, None
     
-    parts = result.stdout.strip().strip('"').split('|')
+    parts = description.split('|')
     asn_desc = parts[4].strip() if len(parts) > 4 else ''
     
     return asn, f'"{asn_desc}"'
 
-def query_team_cymru(subnet):
+async def query_cymru_dns_bulk(ips):
+    # Cymru's DNS service is built for parallel lookups, so no rate limit delay here
+    resolver = aiodns.DNSResolver()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DNS)
+    
+    async def lookup(ip):
+        async with semaphore:
+            return ip, await query_cymru_dns(resolver, ip)
+    
+    return dict(await asyncio.gather(*(lookup(ip) for ip in ips)))
+
+def query_team_cymru_bulk(subnets: List[str]) -> Dict[str, dict]:
+    # Cymru echoes the queried address in the IP column, map it back to our subnet
+    queried = {subnet.split('/')[0]: subnet for subnet in subnets}
+    results = {}
+    if not subnets:
+        return results
+    
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(('whois.cymru.com', 43))
-        s.send(f'begin\nverbose\n{subnet}\nend\n'.encode())
-        response = s.recv(1024).decode()
-        s.close()
-        
-        for line in response.split('\n'):
-            if '|' in line and not line.startswith('Bulk'):
-                parts = line.split('|')
-                return {
-                    'data': {
-                        'asns': [{
-                            'asn': parts[0].strip(),
-                            'holder': f'"{parts[6].strip()}"',
-                            'country': parts[3].strip() if len(parts) > 3 else ''
-                        }]
+        with socket.create_connection(('whois.cymru.com', 43), timeout=WHOIS_TIMEOUT) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            with s.makefile('rwb') as fp:
+                fp.write(('begin\nverbose\n' + '\n'.join(subnets) + '\nend\n').encode())
+                fp.flush()
+                
+                # Read the full response line by line until the server closes the connection
+                while True:
+                    line = fp.readline()
+                    if not line:
+                        break
+                    line = line.decode(errors='replace')
+                    if '|' not in line or line.startswith('Bulk'):
+                        continue
+                    parts = line.split('|')
+                    # Skip the column header and malformed rows
+                    if len(parts) < 7 or parts[0].strip() == 'AS':
+                        continue
+                    subnet = queried.get(parts[1].strip(), parts[2].strip())
+                    results[subnet] = {
+                        'data': {
+                            'asns': [{
+                                'asn': parts[0].strip(),
+                                'holder': f'"{parts[6].strip()}"',
+                                'country': parts[3].strip()
+                            }]
+                        }
                     }
-                }
-    except:
-        return None
+    except OSError:
+        # Timeouts and connection errors keep whatever was parsed so far, misses fall back to the RIR APIs
+        pass
+    
+    return results
+
+def map_log_file(input_file, stack):
+    # Keep the log mapped for the whole run, the detailed output is sliced straight from it
+    if os.path.getsize(input_file) == 0:
+        return b''
+    file = stack.enter_context(open(input_file, 'rb'))
+    return stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
 
-def get_unique_subnets(input_file):
-    ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-    subnet_counts = {}
+def scan_log(data):
+    ip_values = []
+    line_starts = []
+    line_ends = []
     
-    with open(input_file, 'r') as file:
-        for line in file:
-            ips = re.findall(ip_pattern, line)
-            for ip in ips:
-                try:
-                    if ipaddress.ip_address(ip):
-                        network = '.'.join(ip.split('.')[:2]) + '.0.0/16'
-                        subnet_counts[network] = subnet_counts.get(network, 0) + 1
-                except ValueError:
+    # Scan the whole mapped file at once, line bounds are only located when a match enters a new line
+    line_end = -1
+    for match in _IP_RE.finditer(data):
+        try:
+            ip_value = struct.unpack('>I', socket.inet_pton(socket.AF_INET, match.group().decode()))[0]
+        except OSError:
+            continue
+        
+        if match.start() > line_end:
+            line_start = data.rfind(b'\n', 0, match.start()) + 1
+            line_end = data.find(b'\n', match.end())
+            if line_end == -1:
+                line_end = len(data)
+        
+        ip_values.append(ip_value)
+        line_starts.append(line_start)
+        line_ends.append(line_end)
+    
+    return (np.array(ip_values, dtype=np.uint32),
+            np.array(line_starts, dtype=np.int64),
+            np.array(line_ends, dtype=np.int64))
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _is_word_byte(c):
+        return (48 <= c <= 57) or (65 <= c <= 90) or (97 <= c <= 122) or c == 95
+
+    @numba.njit(cache=True)
+    def _scan_chunk(buf, lo, hi, ips, starts, ends):
+        # Same matches as _IP_RE plus the inet_pton validity check, for one chunk starting at a line boundary
+        count = 0
+        line_start = lo
+        line_end = -1
+        i = lo
+        while i < hi:
+            c = buf[i]
+            if c == 10:
+                line_start = i + 1
+            elif 48 <= c <= 57 and (i == 0 or not _is_word_byte(buf[i - 1])):
+                value = 0
+                matched = True
+                valid = True
+                j = i
+                for group in range(4):
+                    k = j
+                    octet = 0
+                    while k < hi and k - j < 4 and 48 <= buf[k] <= 57:
+                        octet = octet * 10 + (buf[k] - 48)
+                        k += 1
+                    digits = k - j
+                    if digits == 0 or digits > 3:
+                        matched = False
+                        break
+                    if group < 3 and (k >= hi or buf[k] != 46):
+                        matched = False
+                        break
+                    if group == 3 and k < hi and _is_word_byte(buf[k]):
+                        matched = False
+                        break
+                    if octet > 255 or (digits > 1 and buf[j] == 48):
+                        valid = False
+                    value = value * 256 + octet
+                    j = k + 1 if group < 3 else k
+                
+                if matched:
+                    if valid:
+                        if line_end < i:
+                            line_end = j
+                            while line_end < hi and buf[line_end] != 10:
+                                line_end += 1
+                        ips[count] = value
+                        starts[count] = line_start
+                        ends[count] = line_end
+                        count += 1
+                    i = j
                     continue
+            i += 1
+        return count
+
+    @numba.njit(parallel=True, cache=True)
+    def _scan_chunks(buf, bounds):
+        n_chunks = len(bounds) - 1
+        # Shortest address plus separator is 8 bytes, which bounds the matches per chunk
+        capacity = np.empty(n_chunks + 1, dtype=np.int64)
+        capacity[0] = 0
+        for c in range(n_chunks):
+            capacity[c + 1] = capacity[c] + (bounds[c + 1] - bounds[c]) // 8 + 1
+        ips = np.empty(capacity[n_chunks], dtype=np.uint32)
+        starts = np.empty(capacity[n_chunks], dtype=np.int64)
+        ends = np.empty(capacity[n_chunks], dtype=np.int64)
+        counts = np.zeros(n_chunks, dtype=np.int64)
+        
+        for c in numba.prange(n_chunks):
+            lo = capacity[c]
+            hi = capacity[c + 1]
+            counts[c] = _scan_chunk(buf, bounds[c], bounds[c + 1], ips[lo:hi], starts[lo:hi], ends[lo:hi])
+        
+        total = counts.sum()
+        out_ips = np.empty(total, dtype=np.uint32)
+        out_starts = np.empty(total, dtype=np.int64)
+        out_ends = np.empty(total, dtype=np.int64)
+        position = 0
+        for c in range(n_chunks):
+            lo = capacity[c]
+            n = counts[c]
+            out_ips[position:position + n] = ips[lo:lo + n]
+            out_starts[position:position + n] = starts[lo:lo + n]
+            out_ends[position:position + n] = ends[lo:lo + n]
+            position += n
+        return out_ips, out_starts, out_ends
+
+def scan_log_compiled(data):
+    # Split on line boundaries so every chunk can be scanned independently
+    n_chunks = numba.get_num_threads() * 4
+    chunk_size = max(len(data) // n_chunks, 1)
+    bounds = [0]
+    while bounds[-1] < len(data):
+        next_newline = data.find(b'\n', bounds[-1] + chunk_size)
+        bounds.append(len(data) if next_newline == -1 else next_newline + 1)
+    return _scan_chunks(np.frombuffer(data, dtype=np.uint8), np.array(bounds, dtype=np.int64))
+
+def get_unique_subnets(data):
+    # Structure-of-arrays view of the log: one uint32 per IP plus the bounds of the line it came from
+    ips, line_starts, line_ends = scan_log_compiled(data) if numba is not None else scan_log(data)
+    log_index = {
+        'data': data,
+        'ips': ips,
+        'line_starts': line_starts,
+        'line_ends': line_ends
+    }
+    
+    ip_prefixes = log_index['ips'] >> 16
+    prefixes, first_positions, counts = np.unique(ip_prefixes, return_index=True, return_counts=True)
+    subnets = [f"{prefix >> 8}.{prefix & 0xFF}.0.0/16" for prefix in prefixes.tolist()]
+    subnet_counts = dict(zip(subnets, counts.tolist()))
+    
+    # First IP seen in each subnet, used as the sample for RDAP/WHOIS lookups
+    log_index['first_ip_per_subnet'] = {
+        subnet: socket.inet_ntoa(struct.pack('>I', ip_value))
+        for subnet, ip_value in zip(subnets, log_index['ips'][first_positions].tolist())
+    }
+    
+    # Group IP positions by subnet once so later lookups are a dict access
+    order = np.argsort(ip_prefixes, kind='stable')
+    log_index['subnet_matches'] = dict(zip(subnets, np.split(order, np.cumsum(counts)[:-1])))
     
-    return sorted(list(subnet_counts.keys())), subnet_counts
-
-def get_sample_ip_for_subnet(subnet, input_file):
-    with open(input_file, 'r') as file:
-        for line in file:
-            ip = line.split()[1]
-            if ipaddress.ip_address(ip) in ipaddress.ip_network(subnet):
-                return ip
+    return subnets, subnet_counts, log_index
+
+def get_subnet_matches(log_index, subnet):
+    return log_index['subnet_matches'].get(subnet, np.empty(0, dtype=np.int64))
+
+def find_subnet_ip(line, subnet):
+    # The first valid IP on the line that belongs to the subnet the row was written under
+    network_prefix = subnet.split('.')[:2]
+    for match in _IP_RE.finditer(str(line).encode()):
+        ip = match.group().decode()
+        try:
+            socket.inet_pton(socket.AF_INET, ip)
+        except OSError:
+            continue
+        if ip.split('.')[:2] == network_prefix:
+            return ip
     return None
 
-def query_rir_api(endpoint, subnet, verbose=False):
+def format_csv_row(fields):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(fields)
+    return buffer.getvalue().encode()
+
+def write_detailed_rows(outfile, log_index, subnet, asn, holder, country):
+    # A line referencing several IPs in the subnet is only written once
+    matches = get_subnet_matches(log_index, subnet)
+    starts, first = np.unique(log_index['line_starts'][matches], return_index=True)
+    ends = log_index['line_ends'][matches][first]
+    
+    # The columns shared by every row of the subnet are formatted once
+    data = log_index['data']
+    suffix = b',' + format_csv_row([subnet, asn, holder, country])
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        line = data[start:end].strip()
+        if b',' in line or b'"' in line or b'\r' in line:
+            line = b'"' + line.replace(b'"', b'""') + b'"'
+        outfile.write(line + suffix)
+
+async def first_valid_result(coros):
+    # Run lookups concurrently, return the first usable answer and cancel the rest
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
     try:
-        headers = {'Accept': 'application/json'}
-        response = requests.get(f"{endpoint}{subnet}", headers=headers, timeout=10)
-        if response.status_code == 200:
-            return response.json()
-        if verbose:
-            print(f"  → Status code {response.status_code} from {endpoint}")
+        for next_result in asyncio.as_completed(tasks):
+            # A lookup that fails (e.g. an unexpected payload shape) counts as a miss
+            try:
+                result = await next_result
+            except Exception:
+                continue
+            if result:
+                return result
         return None
-    except requests.Timeout:
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Token bucket per API host, each RIR enforces its own rate limit
+host_limiters = {}
+
+def get_host_limiter(url):
+    host = urlsplit(url).netloc
+    if host not in host_limiters:
+        host_limiters[host] = AsyncLimiter(max_rate=RATE_LIMIT_PER_HOST, time_period=1)
+    return host_limiters[host]
+
+async def session_get(session, url):
+    limiter = get_host_limiter(url)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with limiter:
+                response = await session.get(url)
+        except aiohttp.ClientConnectionError:
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return response
+            response.release()
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+async def query_rir_api(session, endpoint, subnet, verbose=False):
+    try:
+        async with await session_get(session, f"{endpoint}{subnet}") as response:
+            if response.status == 200:
+                return orjson.loads(await response.read())
+            if verbose:
+                print(f"  → Status code {response.status} from {endpoint}")
+            return None
+    except asyncio.TimeoutError:
         if verbose:
             print(f"  → Timeout while querying {endpoint}")
         return None
-    except requests.RequestException as e:
+    except aiohttp.ClientError as e:
         if verbose:
             print(f"  → Error querying {endpoint}: {str(e)}")
         return None
@@ -130,73 +408,80 @@ def query_rir_api(endpoint, subnet, verbose=False):
         if verbose:
             print(f"  → Invalid JSON from {endpoint}")
         return None
-    finally:
-        time.sleep(RATE_LIMIT_DELAY/1000)
 
-def get_route_data(subnet, verbose=False):
-    def is_valid_data(asn, holder):
-        return asn and holder and asn.upper() != 'NA' and holder.upper() != 'NA' and holder != '""'
+def is_valid_data(asn, holder):
+    return asn and holder and asn.upper() != 'NA' and holder.upper() != 'NA' and holder != '""'
 
-    # Try Team Cymru first
-    cymru_data = query_team_cymru(subnet)
+async def query_rir_source(session, rir, endpoint, subnet, verbose=False):
+    data = await query_rir_api(session, endpoint, subnet, verbose)
+    if not data:
+        return None
+
+    if rir == 'RIPE':
+        if data.get('data', {}).get('asns'):
+            asn = data['data']['asns'][0].get('asn', 'NA')
+            holder = data['data']['asns'][0].get('holder', 'NA')
+            if is_valid_data(asn, holder):
+                return rir, {'data': {'asns': [{'asn': str(asn), 'holder': f'"{holder}"'}]}}
+
+    elif rir in ('LACNIC', 'APNIC', 'AFRINIC'):
+        if data.get('entities'):
+            asn = data['entities'][0].get('handle', 'NA').replace('AS', '')
+            holder = data['entities'][0].get('name', 'NA')
+            if is_valid_data(asn, holder):
+                return rir, {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
+
+    elif rir == 'ARIN':
+        if data.get('handle'):
+            asn = data.get('originASNs', {}).get('originASN', [{}])[0].get('originAS', 'NA').replace('AS', '')
+            holder = data.get('name', 'NA')
+            if is_valid_data(asn, holder):
+                return rir, {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
+
+    return None
+
+async def get_route_data(session, subnet, cache, unresolved, log_index, cymru_data=None, verbose=False):
+    route_data = load_cached(cache, 'route_cache', subnet)
+    if route_data:
+        print(f"  → {subnet}: Found cached route data")
+        return route_data
+    
+    route_data = await lookup_route_data(session, subnet, unresolved, log_index, cymru_data, verbose)
+    asn_entry = route_data['data']['asns'][0]
+    if is_valid_data(str(asn_entry['asn']), asn_entry.get('holder', '')):
+        store_cached(cache, 'route_cache', subnet, route_data)
+    return route_data
+
+async def lookup_route_data(session, subnet, unresolved, log_index, cymru_data=None, verbose=False):
+    # Try Team Cymru bulk result first
     if cymru_data and is_valid_data(cymru_data['data']['asns'][0]['asn'], cymru_data['data']['asns'][0].get('holder', '')):
-        print(f"  → Found valid data via Team Cymru")
+        print(f"  → {subnet}: Found valid data via Team Cymru")
         return cymru_data
 
-    # Try each RIR's APIs
-    print(f"  → Trying RIR APIs...")
-    for rir, endpoints in ROUTING_APIS.items():
-        for endpoint in endpoints:
-            data = query_rir_api(endpoint, subnet)
-            if data:
-                if rir == 'RIPE':
-                    if data.get('data', {}).get('asns'):
-                        asn = data['data']['asns'][0].get('asn', 'NA')
-                        holder = data['data']['asns'][0].get('holder', 'NA')
-                        if is_valid_data(asn, holder):
-                            print(f"  → Found valid data via RIPE")
-                            return {'data': {'asns': [{'asn': str(asn), 'holder': f'"{holder}"'}]}}
-                
-                elif rir == 'LACNIC':
-                    if data.get('entities'):
-                        asn = data['entities'][0].get('handle', 'NA').replace('AS', '')
-                        holder = data['entities'][0].get('name', 'NA')
-                        if is_valid_data(asn, holder):
-                            print(f"  → Found valid data via LACNIC")
-                            return {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
-                
-                elif rir == 'APNIC':
-                    if data.get('entities'):
-                        asn = data['entities'][0].get('handle', 'NA').replace('AS', '')
-                        holder = data['entities'][0].get('name', 'NA')
-                        if is_valid_data(asn, holder):
-                            print(f"  → Found valid data via APNIC")
-                            return {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
-                
-                elif rir == 'AFRINIC':
-                    if data.get('entities'):
-                        asn = data['entities'][0].get('handle', 'NA').replace('AS', '')
-                        holder = data['entities'][0].get('name', 'NA')
-                        if is_valid_data(asn, holder):
-                            print(f"  → Found valid data via AFRINIC")
-                            return {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
-                
-                elif rir == 'ARIN':
-                    if data.get('handle'):
-                        asn = data.get('originASNs', {}).get('originASN', [{}])[0].get('originAS', 'NA').replace('AS', '')
-                        holder = data.get('name', 'NA')
-                        if is_valid_data(asn, holder):
-                            print(f"  → Found valid data via ARIN")
-                            return {'data': {'asns': [{'asn': asn, 'holder': f'"{holder}"'}]}}
-
-    # Fallback to RDAP/WHOIS lookup using ipwhois
-    print(f"  → Falling back to RDAP/WHOIS lookup...")
-    sample_ip = get_sample_ip_for_subnet(subnet, INPUT_FILE)
+    # Query all RIR APIs concurrently and keep the first valid answer
+    print(f"  → {subnet}: Trying RIR APIs...")
+    result = await first_valid_result(
+        query_rir_source(session, rir, endpoint, subnet, verbose)
+        for rir, endpoints in ROUTING_APIS.items()
+        for endpoint in endpoints
+    )
+    if result:
+        rir, route_data = result
+        print(f"  → {subnet}: Found valid data via {rir}")
+        return route_data
+
+    # Fallback to RDAP/WHOIS lookup using ipwhois, unless earlier runs already failed it
+    if subnet in unresolved:
+        print(f"  → {subnet}: Skipping RDAP/WHOIS lookup, previously unresolvable")
+        return {'data': {'asns': [{'asn': 'NA', 'holder': '"NA"'}]}}
+    
+    print(f"  → {subnet}: Falling back to RDAP/WHOIS lookup...")
+    sample_ip = log_index['first_ip_per_subnet'].get(subnet)
     if sample_ip:
         try:
-            print(f"  → Using sample IP: {sample_ip}")
+            print(f"  → {subnet}: Using sample IP: {sample_ip}")
             obj = IPWhois(sample_ip)
-            results = obj.lookup_rdap()
+            results = await asyncio.to_thread(obj.lookup_rdap)
             
             if results.get('asn') and results.get('network', {}).get('name'):
                 asn = results['asn']
@@ -204,7 +489,7 @@ def get_route_data(subnet, verbose=False):
                 country = results.get('asn_country_code', '')
                 
                 if is_valid_data(asn, holder):
-                    print(f"  → Found valid data via RDAP")
+                    print(f"  → {subnet}: Found valid data via RDAP")
                     return {
                         'data': {
                             'asns': [{
@@ -214,6 +499,9 @@ def get_route_data(subnet, verbose=False):
                             }]
                         }
                     }
+            
+            # RDAP answered without a usable ASN, so later runs can skip it. Failed lookups are retried
+            unresolved.add(subnet)
         except (IPDefinedError, HTTPLookupError) as e:
             if verbose:
                 print(f"  → RDAP lookup failed: {str(e)}")
@@ -221,19 +509,65 @@ def get_route_data(subnet, verbose=False):
             if verbose:
                 print(f"  → Error during RDAP lookup: {str(e)}")
     
-    print(f"  → No valid data found from any source")
+    print(f"  → {subnet}: No valid data found from any source")
     return {'data': {'asns': [{'asn': 'NA', 'holder': '"NA"'}]}}
 
-def get_asn_info(asn):
-    for rir, endpoints in ROUTING_APIS.items():
+async def get_asn_info(session, asn, cache):
+    asn_data = load_cached(cache, 'asn_cache', str(asn))
+    if asn_data:
+        return asn_data
+    
+    async def query_asn(endpoint):
         try:
-            response = requests.get(f"{endpoints[0]}?resource={asn}")
-            data = response.json()
-            if data.get('data') or data.get('objects'):
-                return data
-        except:
-            continue
-    return {'data': {}}
+            async with await session_get(session, f"{endpoint}?resource={asn}") as response:
+                data = orjson.loads(await response.read())
+                if data.get('data') or data.get('objects'):
+                    return data
+        except Exception:
+            return None
+
+    data = await first_valid_result(query_asn(endpoints[0]) for endpoints in ROUTING_APIS.values())
+    if data:
+        store_cached(cache, 'asn_cache', str(asn), data)
+    return data or {'data': {}}
+
+def open_cache(cache_file=CACHE_FILE):
+    cache = sqlite3.connect(cache_file)
+    cache.execute('CREATE TABLE IF NOT EXISTS route_cache (key TEXT PRIMARY KEY, json TEXT, ts INTEGER)')
+    cache.execute('CREATE TABLE IF NOT EXISTS asn_cache (key TEXT PRIMARY KEY, json TEXT, ts INTEGER)')
+    return cache
+
+def load_cached(cache, table, key):
+    row = cache.execute(f'SELECT json, ts FROM {table} WHERE key = ?', (key,)).fetchone()
+    if row and time.time() - row[1] < CACHE_TTL:
+        return json.loads(row[0])
+    return None
+
+def store_cached(cache, table, key, value):
+    cache.execute(f'INSERT OR REPLACE INTO {table} (key, json, ts) VALUES (?, ?, ?)',
+                  (key, json.dumps(value), int(time.time())))
+    cache.commit()
+
+def load_unresolved_filter():
+    if os.path.exists(UNRESOLVED_FILE):
+        with open(UNRESOLVED_FILE, 'rb') as f:
+            return ScalableBloomFilter.fromfile(f)
+    
+    # Rebuild from the NA rows of previous summary files
+    unresolved = ScalableBloomFilter(error_rate=UNRESOLVED_ERROR_RATE)
+    summary_files = [f for f in os.listdir('.') if f.startswith(f'{OUTPUT_FILE_PREFIX}_') and f.endswith('.csv')
+                     and not f.startswith(f'{OUTPUT_FILE_PREFIX}_detailed_')]
+    for summary_file in summary_files:
+        with open(summary_file, newline='') as f:
+            for row in csv.DictReader(f):
+                # Rows truncated by a crash may lack columns
+                if row.get('subnet') and (row.get('asn') or '').upper() in ('NA', ''):
+                    unresolved.add(row['subnet'])
+    return unresolved
+
+def save_unresolved_filter(unresolved):
+    with open(UNRESOLVED_FILE, 'wb') as f:
+        unresolved.tofile(f)
 
 def find_checkpoint_files():
     checkpoint_files = [f for f in os.listdir('.') if f.startswith(f'{OUTPUT_FILE_PREFIX}_checkpoint_')]
@@ -246,6 +580,74 @@ def get_related_files(checkpoint_file):
         'detailed': f'{OUTPUT_FILE_PREFIX}_detailed_{timestamp}.csv'
     }
 
+def flush_outputs(outputs):
+    # Flush the data files before the checkpoint so it never lists a subnet whose rows were lost
+    outputs['summary_fh'].flush()
+    outputs['detailed_fh'].flush()
+    outputs['checkpoint_fh'].flush()
+    os.fsync(outputs['checkpoint_fh'].fileno())
+
+async def process_subnet(session, semaphore, cache, unresolved, log_index, subnet, label, count, cymru_data, outputs, verbose=False):
+    async with semaphore:
+        print(f"{label} Processing subnet: {subnet}")
+        
+        try:
+            route_data = await get_route_data(session, subnet, cache, unresolved, log_index, cymru_data, verbose)
+            
+            if route_data['data'].get('asns'):
+                asn = route_data['data']['asns'][0]['asn']
+                print(f"  → {subnet}: Found ASN: {asn}")
+                
+                # Team Cymru and RDAP already return holder and country, only look the ASN up otherwise
+                asn_entry = route_data['data']['asns'][0]
+                if asn_entry.get('holder') and asn_entry.get('country'):
+                    holder = asn_entry['holder']
+                    country = asn_entry['country']
+                else:
+                    asn_data = await get_asn_info(session, asn, cache)
+                    holder = asn_data['data'].get('holder', asn_entry.get('holder', ''))
+                    country = asn_data['data'].get('country', asn_entry.get('country', ''))
+                
+                print(f"  → {subnet}: Retrieved ASN details: {holder}")
+                
+                # Write to summary file incrementally
+                outputs['summary'].writerow([subnet, str(asn), holder, country, count])
+                
+                # Write to detailed file incrementally
+                write_detailed_rows(outputs['detailed_fh'], log_index, subnet, asn, holder, country)
+            else:
+                print(f"  → No routing data found for {subnet}")
+            
+            # Save checkpoint after each successful processing
+            outputs['checkpoint_fh'].write(f"{subnet}\n")
+            outputs['processed'] += 1
+            if outputs['processed'] % CHECKPOINT_INTERVAL == 0:
+                flush_outputs(outputs)
+            
+        except Exception as e:
+            if verbose:
+                print(f"  → Error processing {subnet}: {str(e)}")
+
+async def collect_routes(subnets, subnet_counts, log_index, processed_subnets, cache, unresolved, cymru_results, outputs, verbose=False):
+    total_subnets = len(subnets)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SUBNETS)
+    # One keep-alive connection pool shared by every lookup in the run
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=10)
+    headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        pending = []
+        for idx, subnet in enumerate(subnets, 1):
+            if subnet in processed_subnets:
+                print(f"[{idx}/{total_subnets}] Skipping already processed subnet: {subnet}")
+                continue
+            
+            label = f"[{idx}/{total_subnets}]"
+            pending.append(process_subnet(session, semaphore, cache, unresolved, log_index, subnet, label, subnet_counts[subnet], cymru_results.get(subnet), outputs, verbose))
+        
+        await asyncio.gather(*pending)
+
 def process_routes(check_missing=False, use_checkpoint=False, verbose=False):
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_file = f'{OUTPUT_FILE_PREFIX}_{timestamp}.csv'
@@ -284,68 +686,42 @@ def process_routes(check_missing=False, use_checkpoint=False, verbose=False):
         else:
             print("No checkpoint files found. Starting new process.")
     
-    subnets, subnet_counts = get_unique_subnets(INPUT_FILE)
-    total_subnets = len(subnets)
-    
-    print(f"Starting global network data collection for {total_subnets} unique subnets")
-    
-    # Create CSV files with headers if they don't exist
-    if not os.path.exists(output_file):
-        pd.DataFrame(columns=['subnet', 'asn', 'asn_desc', 'country', 'count']).to_csv(output_file, index=False)
-    
-    if not os.path.exists(detailed_output):
-        with open(detailed_output, 'w') as outfile:
-            outfile.write("original_line,subnet,asn,asn_desc,country\n")
-    
-    for idx, subnet in enumerate(subnets, 1):
-        if subnet in processed_subnets:
-            print(f"[{idx}/{total_subnets}] Skipping already processed subnet: {subnet}")
-            continue
-            
-        print(f"[{idx}/{total_subnets}] Processing subnet: {subnet}")
-        route_data = get_route_data(subnet, verbose)
+    with ExitStack() as stack:
+        subnets, subnet_counts, log_index = get_unique_subnets(map_log_file(INPUT_FILE, stack))
+        total_subnets = len(subnets)
         
-        try:
-            if route_data['data'].get('asns'):
-                asn = route_data['data']['asns'][0]['asn']
-                print(f"  → Found ASN: {asn}")
-                
-                asn_data = get_asn_info(asn)
-                holder = asn_data['data'].get('holder', route_data['data']['asns'][0].get('holder', ''))
-                country = asn_data['data'].get('country', route_data['data']['asns'][0].get('country', ''))
-                
-                print(f"  → Retrieved ASN details: {holder}")
-                
-                # Write to summary file incrementally
-                with open(output_file, 'a') as f:
-                    pd.DataFrame([{
-                        'subnet': subnet,
-                        'asn': str(asn),
-                        'asn_desc': holder,
-                        'country': country,
-                        'count': subnet_counts[subnet]
-                    }]).to_csv(f, header=False, index=False)
-                
-                # Write to detailed file incrementally
-                with open(INPUT_FILE, 'r') as infile, open(detailed_output, 'a') as outfile:
-                    for line in infile:
-                        ip = line.split()[1]
-                        if ipaddress.ip_address(ip) in ipaddress.ip_network(subnet):
-                            outfile.write(f"{line.strip()},{subnet},{asn},{holder},{country}\n")
-            else:
-                print(f"  → No routing data found for {subnet}")
-            
-            # Save checkpoint after each successful processing
-            with open(checkpoint_file, 'a') as f:
-                f.write(f"{subnet}\n")
-            processed_subnets.add(subnet)
-            
-        except Exception as e:
-            if verbose:
-                print(f"  → Error processing {subnet}: {str(e)}")
-            continue
+        print(f"Starting global network data collection for {total_subnets} unique subnets")
+        
+        # Open every output once for the whole run, the detailed file takes raw bytes
+        summary_fh = stack.enter_context(open(output_file, 'a', newline=''))
+        detailed_fh = stack.enter_context(open(detailed_output, 'ab'))
+        checkpoint_fh = stack.enter_context(open(checkpoint_file, 'a'))
+        outputs = {
+            'summary': csv.writer(summary_fh, lineterminator='\n'),
+            'summary_fh': summary_fh,
+            'detailed_fh': detailed_fh,
+            'checkpoint_fh': checkpoint_fh,
+            'processed': 0
+        }
+        
+        # Write CSV headers to new files
+        if summary_fh.tell() == 0:
+            outputs['summary'].writerow(['subnet', 'asn', 'asn_desc', 'country', 'count'])
+        if detailed_fh.tell() == 0:
+            detailed_fh.write(format_csv_row(['original_line', 'subnet', 'asn', 'asn_desc', 'country']))
+        
+        # Resolve every uncached pending subnet against Team Cymru in a single bulk session
+        cache = open_cache()
+        stack.callback(cache.close)
+        pending_subnets = [subnet for subnet in subnets
+                           if subnet not in processed_subnets and not load_cached(cache, 'route_cache', subnet)]
+        print(f"Querying Team Cymru for {len(pending_subnets)} subnets...")
+        cymru_results = query_team_cymru_bulk(pending_subnets)
         
-        time.sleep(RATE_LIMIT_DELAY/1000)
+        unresolved = load_unresolved_filter()
+        asyncio.run(collect_routes(subnets, subnet_counts, log_index, processed_subnets, cache, unresolved, cymru_results, outputs, verbose))
+        flush_outputs(outputs)
+        save_unresolved_filter(unresolved)
     
     if check_missing:
         print("\nChecking for missing ASN information...")
@@ -355,43 +731,54 @@ def process_routes(check_missing=False, use_checkpoint=False, verbose=False):
         df_detailed['asn_desc'] = df_detailed['asn_desc'].str.replace('"""', '"')
         df_summary['asn_desc'] = df_summary['asn_desc'].str.replace('"""', '"')
         
-        missing_entries = df_detailed[
-            ((df_detailed['asn'].astype(str).str.upper() == 'NA') & 
-             (df_detailed['asn_desc'].astype(str).str.upper().isin(['"NA"', 'NA']))) |
-            ((df_detailed['asn'].isna()) & (df_detailed['asn_desc'].isna()))
-        ]
+        # pandas parses a bare NA as NaN, so treat NaN and the literal markers alike
+        asn_missing = df_detailed['asn'].isna() | (df_detailed['asn'].astype(str).str.upper() == 'NA')
+        desc_missing = df_detailed['asn_desc'].isna() | df_detailed['asn_desc'].astype(str).str.upper().isin(['"NA"', 'NA'])
+        missing_entries = df_detailed[asn_missing & desc_missing]
         total_missing = len(missing_entries)
         
         if total_missing > 0:
             print(f"Found {total_missing} entries with missing ASN information")
-            updated = False
+            results = {}
+            subnet_updates = {}
+            
+            # Lines can hold IPs from several subnets, look up the one the row was written under
+            missing_ips = pd.Series(
+                [find_subnet_ip(line, subnet) for line, subnet in zip(missing_entries['original_line'], missing_entries['subnet'])],
+                index=missing_entries.index, dtype=object
+            ).dropna()
+            print(f"Querying Team Cymru DNS for {missing_ips.nunique()} unique IPs...")
+            dns_results = asyncio.run(query_cymru_dns_bulk(missing_ips.unique()))
             
             for idx, (index, row) in enumerate(missing_entries.iterrows(), 1):
-                ip = row['original_line'].split()[1]
                 subnet = row['subnet']
-                print(f"[{idx}/{total_missing}] Querying ASN for {ip}")
+                if index not in missing_ips.index:
+                    if verbose:
+                        print(f"[{idx}/{total_missing}] No IP in {subnet} found on line, skipping")
+                    continue
                 
-                asn, asn_desc = query_cymru_dns(ip)
+                ip = missing_ips[index]
+                print(f"[{idx}/{total_missing}] ASN lookup for {ip}")
+                
+                asn, asn_desc = dns_results[ip]
                 if asn and asn_desc:
                     print(f"  → Found ASN: {asn}")
                     print(f"  → Description: {asn_desc}")
                     
-                    df_detailed.loc[index, 'asn'] = str(asn)
-                    df_detailed.loc[index, 'asn_desc'] = str(asn_desc)
-                    
-                    summary_idx = df_summary[df_summary['subnet'] == subnet].index
-                    if not summary_idx.empty:
-                        df_summary.loc[summary_idx[0], 'asn'] = str(asn)
-                        df_summary.loc[summary_idx[0], 'asn_desc'] = str(asn_desc)
-                    
-                    updated = True
+                    results[index] = (str(asn), str(asn_desc))
+                    subnet_updates[subnet] = (str(asn), str(asn_desc))
                 else:
                     if verbose:
                         print(f"  → No additional data found")
-                
-                time.sleep(RATE_LIMIT_DELAY/1000)
             
-            if updated:
+            if results:
+                # Apply all lookups in one vectorized update per frame
+                df_detailed.update(pd.DataFrame.from_dict(results, orient='index', columns=['asn', 'asn_desc']))
+                
+                df_summary = df_summary.set_index('subnet')
+                df_summary.update(pd.DataFrame.from_dict(subnet_updates, orient='index', columns=['asn', 'asn_desc']))
+                df_summary = df_summary.reset_index()
+                
                 df_detailed.to_csv(detailed_output, index=False)
                 df_summary.to_csv(output_file, index=False)
                 print("\nUpdated both detailed and summary outputs with new ASN information")